@@ -2,19 +2,86 @@
 """SD Card Monitor - Detects insertion and removal of SD cards."""
 
 import argparse
+import json
 import os
 import pwd
+import select
 import signal
 import time
 import subprocess
-import pyudev
-import yaml
+import re
 import sys
 
+try:
+    import pyudev
+except ImportError:
+    print("Error: pip install pyudev")
+    sys.exit(1)
+
+# uevent actions we handle; "change" resolves to insert or remove via has_media
+INSERT, REMOVE, CHANGE = 1, 2, 3
+ACTIONS = {"add": INSERT, "remove": REMOVE, "change": CHANGE}
+
+# Either set is enough for a cart to open a window, X11 or Wayland
+USABLE_DISPLAY_VARS = (
+    ("DISPLAY", "XAUTHORITY"),
+    ("WAYLAND_DISPLAY", "DBUS_SESSION_BUS_ADDRESS"),
+)
+
+# Kept open across insertions and rewound before each read
+mounts_fd = None
+
+# cart.yaml only has one key we care about, so match it directly
+EXEC_RE = re.compile(r"^exec:(?:[ \t]+(.*?))?[ \t]*\r?$", re.M)
+DOUBLE_QUOTED_RE = re.compile(r'"((?:[^"\\]|\\.)*)"[ \t]*(?:#.*)?')
+SINGLE_QUOTED_RE = re.compile(r"'((?:[^']|'')*)'[ \t]*(?:#.*)?")
+COMMENT_RE = re.compile(r"[ \t]#")
+# Plain scalars YAML resolves to null, bool, number or date rather than a string
+NON_STRING_RE = re.compile(
+    r"~|null|Null|NULL"
+    r"|yes|Yes|YES|no|No|NO|true|True|TRUE|false|False|FALSE|on|On|ON|off|Off|OFF"
+    r"|[-+]?(?:0x[0-9a-fA-F_]+|0b[01_]+|[0-9][0-9_:]*(?:\.[0-9_]*)?(?:[eE][-+]?[0-9]+)?"
+    r"|\.[0-9_]+(?:[eE][-+]?[0-9]+)?|\.(?:inf|Inf|INF))"
+    r"|\.(?:nan|NaN|NAN)"
+    r"|[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}(?:[Tt \t].*)?"
+)
+
+
+def _read_fd(fd):
+    """Read from fd until EOF; seq_file reads return about a page at a time."""
+    chunks = []
+    while True:
+        chunk = os.read(fd, 1 << 16)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def _read_proc(path):
+    """Read a whole procfs or sysfs file through a raw fd."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _read_fd(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_sysfs_int(path):
+    """Read a single integer sysfs attribute."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return int(os.read(fd, 32))
+    finally:
+        os.close(fd)
+
 
 def is_sd_card(device):
-    """Check if the device is an SD card (not a partition)."""
-    if not device.device_node or device.device_type != "disk":
+    """Check if the disk device is an SD card."""
+    if not device.device_node:
+        return False
+
+    # Only mmcblk* and sd* can be SD cards, skip property lookups for the rest
+    if not device.sys_name.startswith(("mmcblk", "sd")):
         return False
 
     node = device.device_node
@@ -31,10 +98,9 @@ def is_sd_card(device):
             # Check sysfs for removable flag
             try:
                 removable_path = f"/sys/block/{node.split('/')[-1]}/removable"
-                with open(removable_path) as f:
-                    if f.read().strip() == "1":
-                        return True
-            except (IOError, OSError):
+                if _read_sysfs_int(removable_path) == 1:
+                    return True
+            except (IOError, OSError, ValueError):
                 pass
 
     return False
@@ -50,75 +116,162 @@ def has_media(device):
     # Check device size through sysfs
     try:
         name = device.device_node.split("/")[-1]
-        with open(f"/sys/block/{name}/size") as f:
-            return int(f.read().strip()) > 0
+        return _read_sysfs_int(f"/sys/block/{name}/size") > 0
     except (IOError, OSError, ValueError):
         return False
 
 
+def get_mounts_fd():
+    """Return a cached fd for /proc/self/mounts, opening it on first use."""
+    global mounts_fd
+    if mounts_fd is None:
+        mounts_fd = os.open("/proc/self/mounts", os.O_RDONLY)
+    return mounts_fd
+
+
 def get_mount_point(device_node, timeout=5):
     """Wait for device to be mounted and return mount point."""
     # Check for partitions (e.g., /dev/sdd1, /dev/mmcblk0p1)
-    partitions = []
     dev_name = device_node.split("/")[-1]
+    try:
+        partitions = frozenset(
+            b"/dev/" + os.fsencode(entry.name)
+            for entry in os.scandir("/sys/block/" + dev_name)
+            if entry.name.startswith(dev_name)
+        )
+    except OSError:
+        partitions = frozenset()
 
-    for _ in range(timeout * 2):
-        # Find partitions for this device
-        try:
-            for entry in os.listdir("/sys/block/" + dev_name):
-                if entry.startswith(dev_name):
-                    partitions.append("/dev/" + entry)
-        except OSError:
-            pass
+    # If no partitions, the device itself might be formatted
+    if not partitions:
+        partitions = frozenset((os.fsencode(device_node),))
 
-        # If no partitions, the device itself might be formatted
-        if not partitions:
-            partitions = [device_node]
+    # /proc/self/mounts raises POLLPRI whenever the mount table changes,
+    # so wait on it instead of re-reading on a timer
+    try:
+        fd = get_mounts_fd()
+    except OSError:
+        return None
 
-        # Check /proc/mounts for mount points
-        try:
-            with open("/proc/mounts") as f:
-                for line in f:
-                    parts = line.split()
-                    if parts[0] in partitions:
-                        return parts[1]
-        except IOError:
-            pass
+    poller = select.poll()
+    poller.register(fd, select.POLLPRI | select.POLLERR)
+    deadline = time.monotonic() + timeout
 
-        time.sleep(0.5)
+    while True:
+        # Check the mount table for mount points
+        os.lseek(fd, 0, os.SEEK_SET)
+        for line in _read_fd(fd).split(b"\n"):
+            source, _, rest = line.partition(b" ")
+            if source in partitions:
+                return os.fsdecode(rest.partition(b" ")[0])
 
-    return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        poller.poll(remaining * 1000)
 
 
-def get_user_display_env(uid):
-    """Get display-related environment variables from user's session."""
+def has_usable_display(display_vars):
+    """Check if the variables are enough for a cart to reach the user's display."""
+    return any(all(key in display_vars for key in keys) for keys in USABLE_DISPLAY_VARS)
+
+
+def get_session_display_env(uid):
+    """Get display-related environment variables from the user's runtime dir and logind."""
     display_vars = {}
-    target_vars = ["DISPLAY", "WAYLAND_DISPLAY", "XAUTHORITY", "DBUS_SESSION_BUS_ADDRESS"]
+    runtime_dir = f"/run/user/{uid}"
 
-    # Find a process owned by this user and read its environment
+    if os.path.exists(f"{runtime_dir}/wayland-0"):
+        display_vars["WAYLAND_DISPLAY"] = "wayland-0"
+    if os.path.exists(f"{runtime_dir}/bus"):
+        display_vars["DBUS_SESSION_BUS_ADDRESS"] = f"unix:path={runtime_dir}/bus"
+
+    if os.path.exists(f"{runtime_dir}/gdm/Xauthority"):
+        display_vars["XAUTHORITY"] = f"{runtime_dir}/gdm/Xauthority"
+
+    # A Wayland session needs no help from logind
+    if has_usable_display(display_vars):
+        return display_vars
+
+    # The user's Display property is their graphical session, which in turn
+    # knows its X11 display
     try:
-        for pid in os.listdir("/proc"):
-            if not pid.isdigit():
+        session = subprocess.run(
+            ["loginctl", "show-user", str(uid), "-p", "Display", "--value"],
+            capture_output=True, text=True, timeout=2
+        ).stdout.strip()
+        if session:
+            display = subprocess.run(
+                ["loginctl", "show-session", session, "-p", "Display", "--value"],
+                capture_output=True, text=True, timeout=2
+            ).stdout.strip()
+            if display:
+                display_vars["DISPLAY"] = display
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+    return display_vars
+
+
+def get_user_pids(uid):
+    """Yield pids of the user's processes, from their systemd slice when available."""
+    slice_dir = f"/sys/fs/cgroup/user.slice/user-{uid}.slice"
+    if os.path.isdir(slice_dir):
+        # Every cgroup under the slice lists its member pids
+        for dirpath, _, filenames in os.walk(slice_dir):
+            if "cgroup.procs" not in filenames:
                 continue
             try:
-                stat_path = f"/proc/{pid}/stat"
-                environ_path = f"/proc/{pid}/environ"
-
-                # Check if process belongs to user
-                if os.stat(stat_path).st_uid != uid:
+                pids = _read_proc(os.path.join(dirpath, "cgroup.procs")).split()
+            except OSError:
+                continue
+            for pid in pids:
+                pid = pid.decode()
+                # sudo/pkexec children share the session scope but not the uid
+                try:
+                    if os.stat(f"/proc/{pid}").st_uid == uid:
+                        yield pid
+                except OSError:
                     continue
+        return
 
+    # No cgroup v2 user slice, scan /proc for processes owned by the user
+    with os.scandir("/proc") as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_uid == uid:
+                    yield entry.name
+            except OSError:
+                continue
+
+
+def get_user_display_env(uid):
+    """Get display-related environment variables from user's session."""
+    target_vars = ["DISPLAY", "WAYLAND_DISPLAY", "XAUTHORITY", "DBUS_SESSION_BUS_ADDRESS"]
+
+    display_vars = get_session_display_env(uid)
+    if has_usable_display(display_vars):
+        return display_vars
+
+    # Fill in the rest from the environment of a process owned by this user
+    try:
+        for pid in get_user_pids(uid):
+            try:
                 # Read environment
-                with open(environ_path, "rb") as f:
-                    env_data = f.read().decode("utf-8", errors="ignore")
-                    for item in env_data.split("\0"):
-                        if "=" in item:
-                            key, val = item.split("=", 1)
-                            if key in target_vars and key not in display_vars:
-                                display_vars[key] = val
-
-                # Stop if we found DISPLAY or WAYLAND_DISPLAY
-                if "DISPLAY" in display_vars or "WAYLAND_DISPLAY" in display_vars:
+                env_data = _read_proc(f"/proc/{pid}/environ").decode("utf-8", errors="ignore")
+                has_display = False
+                for item in env_data.split("\0"):
+                    if "=" in item:
+                        key, val = item.split("=", 1)
+                        if key in ("DISPLAY", "WAYLAND_DISPLAY"):
+                            has_display = True
+                        if key in target_vars and key not in display_vars:
+                            display_vars[key] = val
+
+                # Stop once we've read a process from the graphical session
+                if has_display:
                     break
             except (IOError, OSError, PermissionError):
                 continue
@@ -128,7 +281,71 @@ def get_user_display_env(uid):
     return display_vars
 
 
-def start_cart_process(mount_point, run_as_user=None):
+def parse_cart_exec(data):
+    """Return the exec command from cart.yaml contents, or None if there isn't one.
+
+    Only single-line plain and quoted scalars are understood, anything else
+    raises ValueError rather than risk running a half-parsed command.
+    """
+    text = data.decode("utf-8-sig", errors="replace")
+    match = EXEC_RE.search(text)
+    if not match:
+        return None
+
+    value = match.group(1)
+    if not value:
+        raise ValueError("unsupported exec format, value must be on the exec: line")
+
+    # An indented line after the key continues the value
+    for line in text[match.end():].splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        if line[0] in " \t":
+            raise ValueError("unsupported exec format, value must fit on the exec: line")
+        break
+
+    quoted = DOUBLE_QUOTED_RE.fullmatch(value)
+    if quoted:
+        try:
+            return json.loads(f'"{quoted.group(1)}"')
+        except ValueError:
+            raise ValueError(f"unsupported exec format: {value}")
+    quoted = SINGLE_QUOTED_RE.fullmatch(value)
+    if quoted:
+        return quoted.group(1).replace("''", "'")
+
+    # Plain scalar, which ends at a " #" comment
+    script = COMMENT_RE.split(value, maxsplit=1)[0].strip()
+    if (not script or script[0] in "|>\"'[{&*!%@`#" or ": " in script
+            or NON_STRING_RE.fullmatch(script)):
+        raise ValueError(f"unsupported exec format: {value}")
+    return script
+
+
+def get_user_context(run_as_user):
+    """Resolve the user to run carts as and the environment that goes with them."""
+    pw = pwd.getpwnam(run_as_user)
+    uid, gid = pw.pw_uid, pw.pw_gid
+
+    def switch_user():
+        os.setgid(gid)
+        os.setuid(uid)
+
+    return {
+        "name": run_as_user,
+        "uid": uid,
+        "env": {
+            "HOME": pw.pw_dir,
+            "USER": run_as_user,
+            "LOGNAME": run_as_user,
+            "XDG_RUNTIME_DIR": f"/run/user/{uid}",
+        },
+        "preexec_fn": switch_user,
+    }
+
+
+def start_cart_process(mount_point, user_ctx=None):
     """Check for cart.yaml, parse it, and start the process if found."""
     cart_path = os.path.join(mount_point, "cart.yaml")
     if not os.path.exists(cart_path):
@@ -136,36 +353,29 @@ def start_cart_process(mount_point, run_as_user=None):
         return None
 
     print(f"Found cart.yaml at {cart_path}")
-    with open(cart_path) as f:
-        config = yaml.safe_load(f)
+    with open(cart_path, "rb") as f:
+        try:
+            script = parse_cart_exec(f.read())
+        except ValueError as e:
+            print(f"Can't run cart.yaml, {e}")
+            return None
 
-    if not config or "exec" not in config:
+    if script is None:
         print("No 'exec' field in cart.yaml")
         return None
 
-    script = config["exec"]
-
     # Set up user switching if specified
     preexec_fn = None
     env = os.environ.copy()
-    if run_as_user:
-        pw = pwd.getpwnam(run_as_user)
-        uid, gid = pw.pw_uid, pw.pw_gid
-        env["HOME"] = pw.pw_dir
-        env["USER"] = run_as_user
-        env["LOGNAME"] = run_as_user
-        env["XDG_RUNTIME_DIR"] = f"/run/user/{uid}"
-
-        # Get display environment from user's session
-        user_env = get_user_display_env(uid)
-        env.update(user_env)
+    if user_ctx:
+        env.update(user_ctx["env"])
 
-        def switch_user():
-            os.setgid(gid)
-            os.setuid(uid)
+        # Display environment can change as sessions come and go
+        user_env = get_user_display_env(user_ctx["uid"])
+        env.update(user_env)
 
-        preexec_fn = switch_user
-        print(f"Executing as {run_as_user}: {script}")
+        preexec_fn = user_ctx["preexec_fn"]
+        print(f"Executing as {user_ctx['name']}: {script}")
     else:
         print(f"Executing: {script}")
 
@@ -180,54 +390,93 @@ def kill_cart_process(proc):
     if proc and proc.poll() is None:
         pgid = os.getpgid(proc.pid)
         print(f"Killing process group {pgid}")
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            # No pidfd support, fall back to Popen's timed wait
+            try:
+                os.killpg(pgid, signal.SIGTERM)
+                proc.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                os.killpg(pgid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            return
+
         try:
             os.killpg(pgid, signal.SIGTERM)
-            proc.wait(timeout=3)
-        except subprocess.TimeoutExpired:
-            os.killpg(pgid, signal.SIGKILL)
+            # The pidfd becomes readable as soon as the process exits
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+            if poller.poll(3000):
+                proc.wait()
+            else:
+                os.killpg(pgid, signal.SIGKILL)
         except ProcessLookupError:
             pass
+        finally:
+            os.close(pidfd)
 
 
 def monitor(run_as_user=None):
     context = pyudev.Context()
     # Use 'udev' source only to avoid duplicate kernel events
     monitor = pyudev.Monitor.from_netlink(context, source="udev")
-    monitor.filter_by(subsystem="block")
+    # Filter on devtype in the kernel so partition events never reach us
+    monitor.filter_by(subsystem="block", device_type="disk")
+    try:
+        # Avoid dropped uevents when a reader adds many devices at once
+        monitor.set_receive_buffer_size(1 << 20)
+    except OSError:
+        pass
+
+    # Look the user up once rather than on every insertion
+    user_ctx = get_user_context(run_as_user) if run_as_user else None
 
     print("Monitoring for SD cards... (Ctrl+C to exit)")
     if run_as_user:
         print(f"Exec commands will run as: {run_as_user}")
 
-    last_event = None
+    last_event = (None, 0)
     running_processes = {}  # device_node -> process
+    sd_cache = {}  # device_node -> is_sd_card verdict
 
     try:
         for device in iter(monitor.poll, None):
-            if not is_sd_card(device):
+            # Backs up the kernel-side devtype filter
+            if device.device_type != "disk":
+                continue
+
+            action = ACTIONS.get(device.action)
+            if action is None:
                 continue
 
-            if device.action == "add":
-                event = ("insert", device.device_node)
-            elif device.action == "remove":
-                event = ("remove", device.device_node)
-            elif device.action == "change":
-                event = ("insert" if has_media(device) else "remove", device.device_node)
+            device_node = device.device_node
+            if action == REMOVE:
+                is_sd = sd_cache.pop(device_node, None)
             else:
+                is_sd = sd_cache.get(device_node)
+            if is_sd is None:
+                is_sd = is_sd_card(device)
+                if action != REMOVE:
+                    sd_cache[device_node] = is_sd
+            if not is_sd:
                 continue
 
+            if action == CHANGE:
+                action = INSERT if has_media(device) else REMOVE
+            event = (device_node, action)
+
             # Skip duplicate events
             if event == last_event:
                 continue
             last_event = event
 
-            device_node = event[1]
-
-            if event[0] == "insert":
+            if action == INSERT:
                 print(f"SD card inserted: {device_node}")
                 mount_point = get_mount_point(device_node)
                 if mount_point:
-                    proc = start_cart_process(mount_point, run_as_user)
+                    proc = start_cart_process(mount_point, user_ctx)
                     if proc:
                         running_processes[device_node] = proc
                 else:
@@ -245,12 +494,6 @@ def monitor(run_as_user=None):
 
 
 if __name__ == "__main__":
-    try:
-        import pyudev
-    except ImportError:
-        print("Error: pip install pyudev")
-        sys.exit(1)
-
     parser = argparse.ArgumentParser(description="Monitor SD cards and run cart.yaml scripts")
     parser.add_argument("--user", help="Run exec commands as this user")
     args = parser.parse_args()
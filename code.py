@@ -3,11 +3,16 @@ import time
 import board
 import busio
 import digitalio
+import keypad
 import microcontroller
+import supervisor
 
 import adafruit_is31fl3741
 from adafruit_is31fl3741.adafruit_rgbmatrixqt import Adafruit_RGBMatrixQT
+from adafruit_ticks import ticks_diff
 
+# print() goes out over USB CDC, keep it off the main loop unless debugging
+DEBUG = False
 
 # Cart detection pin, if IO_SD_CART is LOW
 # then a cart (with or without an SD card) is inserted
@@ -34,7 +39,9 @@ IO_SD_LED.direction = digitalio.Direction.INPUT
 IO_SD_LED.pull = digitalio.Pull.DOWN
 
 IO_BUTTON_OUT = digitalio.DigitalInOut(board.GP7)
-IO_BUTTON_IN = digitalio.DigitalInOut(board.GP8)
+# Button edges are captured in the background by keypad,
+# which also debounces them for us
+BUTTON = keypad.Keys((board.GP8,), value_when_pressed=True, pull=True)
 
 IO_POWER_SW = digitalio.DigitalInOut(board.GP20)
 IO_POWER_SW.direction = digitalio.Direction.OUTPUT
@@ -49,7 +56,6 @@ IO_S3.direction = digitalio.Direction.INPUT
 IO_LED_BLUE = digitalio.DigitalInOut(board.GP25)
 IO_LED_BLUE.direction = digitalio.Direction.OUTPUT
 
-IO_BUTTON_IN.direction = digitalio.Direction.INPUT
 IO_BUTTON_OUT.direction = digitalio.Direction.OUTPUT
 IO_BUTTON_OUT.value = True
 
@@ -59,82 +65,112 @@ PIN_SCL = board.GP5
 i2c_working = False
 IO_LED_BLUE.value = True
 
-try:
-    i2c = busio.I2C(sda=PIN_SDA, scl=PIN_SCL)
-    is31 = adafruit_is31fl3741.IS31FL3741(i2c)
-
-    is31 = Adafruit_RGBMatrixQT(i2c, allocate=adafruit_is31fl3741.PREFER_BUFFER)
-    is31.set_led_scaling(0xFF)
-    is31.global_current = 0xFF
-    is31.enable = True
-    i2c_working = True
-    print("i2c working!")
-except:
-    time.sleep(1)
+# Retry transient bus errors a few times before
+# falling back to resetting the whole board
+i2c = None
+for attempt in range(3):
+    try:
+        i2c = busio.I2C(sda=PIN_SDA, scl=PIN_SCL)
+        is31 = Adafruit_RGBMatrixQT(i2c, allocate=adafruit_is31fl3741.PREFER_BUFFER)
+        is31.set_led_scaling(0xFF)
+        is31.global_current = 0xFF
+        is31.enable = True
+        i2c_working = True
+        print("i2c working!")
+        break
+    except (OSError, RuntimeError, ValueError):
+        print("i2c failing!")
+        if i2c is not None:
+            i2c.deinit()
+            i2c = None
+        time.sleep(0.1 * (1 << attempt))
+
+if not i2c_working:
     microcontroller.reset()
-    print("i2c failing!")
-    i2c_working=False
     
-last_value = False
+# Button press time in ticks_ms; monotonic() loses sub-second
+# precision after a few days of uptime, ticks_ms doesn't
+hold_start = None
+HOLD_MS = 300
 
 DEVICE_ON = (True, False)
 DEVICE_SLEEP = (False, True)
 DEVICE_OFF = (False, False)
+
+# Indexed by (S0 << 1) | S3
+STATE_TABLE = (DEVICE_OFF, DEVICE_SLEEP, DEVICE_ON, DEVICE_ON)
         
 last_state = None
 state = None
 
-def set_led(device_state):
-    if not i2c_working:
-        IO_LED_BLUE.value = True
-        return
-
+def draw_state(device_state):
     for y in range(3, 9):
         for x in range(5, 13):
             is31.pixel(x, y, 0x000000)
     
     if device_state == DEVICE_SLEEP:
-        is31.enable = True
         for y in range(3, 9):
             for x in range(12, 13):
                 is31.pixel(x, y, 0x0000FF)
     if device_state == DEVICE_OFF:
-        is31.enable = True
         for y in range(5, 7):
             for x in range(12, 13):
                 is31.pixel(x, y, 0xFF0000)
     if device_state == DEVICE_ON:
-        is31.enable = True
         for y in range(3, 9):
             for x in range(5, 13):
                 is31.pixel(x, y, 0x0000FF)
+
+def render_state(device_state):
+    draw_state(device_state)
+    return bytes(is31._pixel_buffer)
+
+# Render each state once up front so set_led is a single buffer copy.
+# PREFER_BUFFER leaves _pixel_buffer as None if it couldn't be allocated,
+# in which case set_led falls back to drawing pixel by pixel.
+STATE_BUFFERS = None
+if i2c_working and is31._pixel_buffer is not None:
+    STATE_BUFFERS = {
+        DEVICE_ON: render_state(DEVICE_ON),
+        DEVICE_SLEEP: render_state(DEVICE_SLEEP),
+        DEVICE_OFF: render_state(DEVICE_OFF),
+    }
+
+def set_led(device_state):
+    if not i2c_working:
+        IO_LED_BLUE.value = True
+        return
+
+    if STATE_BUFFERS is None:
+        draw_state(device_state)
+        return
+
+    is31._pixel_buffer[:] = STATE_BUFFERS[device_state]
     is31.show()
 
 while True:
-    io_s = (IO_S0.value, IO_S3.value)
-    
-    if io_s == DEVICE_ON:
-        state = DEVICE_ON
-    if io_s == DEVICE_SLEEP:
-        state = DEVICE_SLEEP
-    if io_s == DEVICE_OFF:
-        state = DEVICE_OFF
+    state = STATE_TABLE[(IO_S0.value << 1) | IO_S3.value]
             
     if last_state != state:
         last_state = state
         set_led(state)
         
-    if IO_BUTTON_IN.value != last_value:
-        last_value = IO_BUTTON_IN.value
-        
-        if last_value:
-            time.sleep(0.3)
-            if IO_BUTTON_IN.value == True:
-                IO_POWER_SW.value = False
-                time.sleep(1)
-                IO_POWER_SW.value = True
-            else:
+    event = BUTTON.events.get()
+    if event:
+        if event.pressed:
+            hold_start = event.timestamp
+        elif hold_start is not None:
+            hold_start = None
+            if DEBUG:
                 print("Power not held")
 
+    if hold_start is not None and ticks_diff(supervisor.ticks_ms(), hold_start) >= HOLD_MS:
+        hold_start = None
+        IO_POWER_SW.value = False
+        time.sleep(1)
+        IO_POWER_SW.value = True
+
+    time.sleep(0.01)
+
 
 